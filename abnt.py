@@ -19,26 +19,107 @@ Notas:
 - "Citação longa" e "Referências NBR 6023" têm muita nuance: oferecemos **marcação assistida** e **templates**.
 """
 
+import copy
+import functools
+import gc
 import io
-from typing import Optional, List, Tuple
+import tempfile
+from typing import Optional
 import re
 import streamlit as st
 from docx import Document
-from docx.shared import Cm, Pt
+from docx.shared import Cm, Emu, Pt, Twips
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.oxml import OxmlElement
 from docx.oxml.ns import qn
+from docx.oxml.simpletypes import ST_OnOff
+from docx.styles import BabelFish
+from docx.table import Table
+from docx.text.paragraph import Paragraph
+from lxml import etree
+
+_NSMAP = {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
+
+# Marcadores assistidos: [[CITACAO_LONGA]], [[REFERENCIAS]] e os de fechamento, numa só regex
+_MARKER_RE = re.compile(r'\[\[(/?)(CITACAO_LONGA|REFERENCIAS)\]\]')
+
+_W_T = etree.XPath('.//w:t', namespaces=_NSMAP)
+_HAS_DRAWING = etree.XPath('boolean(.//w:drawing)', namespaces=_NSMAP)
+_HAS_NUMPR = etree.XPath('boolean(.//w:numPr)', namespaces=_NSMAP)
+# Só o texto dos <w:t>, como em Paragraph.text e _strip_markers: string(.) também pegaria
+# w:delText (exclusões controladas) e w:instrText (códigos de campo)
+_T_TEXTS = etree.XPath('.//w:t/text()', namespaces=_NSMAP, smart_strings=False)
+# Espaços que str.strip remove e que cabem em XML; normalize-space só conhece espaço, tab, CR e LF
+_XML_SPACES = ''.join(c for c in map(chr, range(0x20, 0x3001)) if c.isspace())
+# Parágrafos vazios (mesmo critério de _is_blank_p sobre o texto dos <w:t>), selecionados de uma vez
+_BLANK_PS = etree.XPath("./w:p[not(.//w:t[normalize-space(translate(., '%s', '%s'))])"
+                        " and not(.//w:drawing) and not(w:pPr/w:sectPr)]"
+                        % (_XML_SPACES, ' ' * len(_XML_SPACES)), namespaces=_NSMAP)
+_PSTYLE = qn('w:pPr') + '/' + qn('w:pStyle')
+_SECTPR = qn('w:pPr') + '/' + qn('w:sectPr')
+_NUMPR = qn('w:pPr') + '/' + qn('w:numPr')
+_P_TAG = qn('w:p')
+_TBL_TAG = qn('w:tbl')
+_TR_TAG = qn('w:tr')
+_R_TAG = qn('w:r')
+_T_TAG = qn('w:t')
+_CANTSPLIT_TAG = qn('w:cantSplit')
+_TBLHEADER_TAG = qn('w:tblHeader')
+_FLDCHAR_TAG = qn('w:fldChar')
+_INSTRTEXT_TAG = qn('w:instrText')
+_STYLE_TAG = qn('w:style')
+_NAME_TAG = qn('w:name')
+# Atributos gravados nos laços por parágrafo/linha/seção
+_VAL_ATTR = qn('w:val')
+_TYPE_ATTR = qn('w:type')
+_FIRSTLINE_ATTR = qn('w:firstLine')
+_HANGING_ATTR = qn('w:hanging')
+_BEFORE_ATTR = qn('w:before')
+_AFTER_ATTR = qn('w:after')
+_LEFT_ATTR = qn('w:left')
+_RIGHT_ATTR = qn('w:right')
+_TOP_ATTR = qn('w:top')
+_BOTTOM_ATTR = qn('w:bottom')
+_LINE_ATTR = qn('w:line')
+_LINERULE_ATTR = qn('w:lineRule')
+_FLDCHARTYPE_ATTR = qn('w:fldCharType')
+_XML_SPACE_ATTR = qn('xml:space')
+_STYLEID_ATTR = qn('w:styleId')
+_DEFAULT_ATTR = qn('w:default')
+
+# Medidas usadas nos laços, construídas uma vez (cada Cm()/Pt() cria um novo Length)
+_ZERO_CM = Cm(0)
+_PT_0 = Pt(0)
+
+
+@functools.lru_cache(maxsize=16)
+def _cm(value: float):
+    return Cm(value)
+
+
+@functools.lru_cache(maxsize=16)
+def _pt(value: float):
+    return Pt(value)
+
+
+def _text_of(elem) -> str:
+    # Texto visível do elemento (<w:t> concatenados), lido numa só chamada ao libxml2
+    return ''.join(_T_TEXTS(elem))
 
 # =====================
 # ABNT Helper Functions
 # =====================
 
 def set_page_margins(doc: Document, top_cm=3.0, left_cm=3.0, right_cm=2.0, bottom_cm=2.0):
-    for section in doc.sections:
-        section.top_margin = Cm(top_cm)
-        section.left_margin = Cm(left_cm)
-        section.right_margin = Cm(right_cm)
-        section.bottom_margin = Cm(bottom_cm)
+    # <w:pgMar> é em twips: converte uma vez e grava direto em cada <w:sectPr>, sem os setters de Section
+    margins = [(_TOP_ATTR, Cm(top_cm)), (_LEFT_ATTR, Cm(left_cm)),
+               (_RIGHT_ATTR, Cm(right_cm)), (_BOTTOM_ATTR, Cm(bottom_cm))]
+    margins = [(attr, str(value.twips)) for attr, value in margins]
+    # sectPr_lst: os mesmos <w:sectPr> que doc.sections percorre, sem montar um Section por item
+    for sectPr in doc.element.sectPr_lst:
+        pgMar = sectPr.get_or_add_pgMar()
+        for attr, value in margins:
+            pgMar.set(attr, value)
 
 
 def configure_default_style(doc: Document, font_name="Times New Roman", font_size_pt=12, line_spacing=1.5,
@@ -53,119 +134,161 @@ def configure_default_style(doc: Document, font_name="Times New Roman", font_siz
     pf.first_line_indent = Cm(first_line_indent_cm)
 
 
-def style_all_paragraphs(doc: Document, justify=True, first_line_indent_cm=1.25):
-    """Aplica estilo base ABNT a todos os parágrafos que não são headings.
-    - Headings: esquerda, sem recuo, sem espaçamentos extras
-    - Corpo: justificado (opcional), 1,5, recuo de 1ª linha
+def _paragraph_style_names(doc: Document) -> dict:
+    """Mapeia style_id → nome dos estilos de parágrafo (ex.: 'Ttulo1' → 'Heading 1'), lido uma vez.
+    A chave None guarda o estilo padrão, que vale para parágrafos sem <w:pStyle>.
     """
-    for p in doc.paragraphs:
-        if p.style and p.style.name.lower().startswith("heading"):
-            p.alignment = WD_ALIGN_PARAGRAPH.LEFT
-            p.paragraph_format.first_line_indent = Cm(0)
-            p.paragraph_format.space_before = Pt(0)
-            p.paragraph_format.space_after = Pt(0)
-        else:
-            if justify:
-                p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-            p.paragraph_format.first_line_indent = Cm(first_line_indent_cm)
-            p.paragraph_format.space_before = Pt(0)
-            p.paragraph_format.space_after = Pt(0)
-    for p in doc.paragraphs:
-        text = p.text.strip()
-        # Headings: alinhar à esquerda, sem recuo
-        if p.style and p.style.name.lower().startswith("heading"):
-            p.alignment = WD_ALIGN_PARAGRAPH.LEFT
-            p.paragraph_format.first_line_indent = Cm(0)
-            p.paragraph_format.space_before = Pt(0)
-            p.paragraph_format.space_after = Pt(0)
-        else:
-            if justify:
-                p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-            p.paragraph_format.first_line_indent = Cm(first_line_indent_cm)
-            p.paragraph_format.space_before = Pt(0)
-            p.paragraph_format.space_after = Pt(0)
+    # Lido direto dos <w:style>, sem um objeto Style por estilo (styles.xml costuma ter centenas);
+    # mesmas regras de Style.type/.name e Styles.default do python-docx
+    names = {None: ""}
+    for s in doc.styles.element.iterchildren(_STYLE_TAG):
+        kind = s.get(_TYPE_ATTR)
+        if kind not in (None, 'paragraph'):
+            continue
+        name_el = s.find(_NAME_TAG)
+        name = name_el.get(_VAL_ATTR) if name_el is not None else None
+        name = BabelFish.internal2ui(name) if name is not None else ""
+        names[s.get(_STYLEID_ATTR)] = name
+        default = s.get(_DEFAULT_ATTR)
+        # ST_OnOff aceita 1/0, true/false e on/off; vale o último padrão, como em Styles.default
+        if kind == 'paragraph' and default is not None and ST_OnOff.convert_from_xml(default):
+            names[None] = name
+    return names
+
+
+def _style_name_of(p_elem, style_names: dict) -> str:
+    # Lê w:pStyle/@w:val direto do XML, sem passar por p.style (que resolve via styles part)
+    pStyle = p_elem.find(_PSTYLE)
+    sid = pStyle.get(_VAL_ATTR) if pStyle is not None else None
+    return style_names.get(sid, style_names[None])
+
+
+def _force_pPr(p_elem, jc: Optional[str], indent_twips: int):
+    """Grava alinhamento (`jc`, se informado), recuo de 1ª linha e espaçamentos direto no <w:pPr>.
+    Um único acesso ao pPr por parágrafo; os demais filhos (pStyle, numPr, sectPr...) são mantidos.
+    """
+    pPr = p_elem.get_or_add_pPr()
+    if jc is not None:
+        pPr.get_or_add_jc().set(_VAL_ATTR, jc)
+    ind = pPr.get_or_add_ind()
+    if indent_twips < 0:
+        ind.attrib.pop(_FIRSTLINE_ATTR, None)
+        ind.set(_HANGING_ATTR, str(-indent_twips))
+    else:
+        ind.attrib.pop(_HANGING_ATTR, None)
+        ind.set(_FIRSTLINE_ATTR, str(indent_twips))
+    spacing = pPr.get_or_add_spacing()
+    spacing.set(_BEFORE_ATTR, '0')
+    spacing.set(_AFTER_ATTR, '0')
+
+
+def _clear_direct_pPr(p_elem, jc: Optional[str]) -> None:
+    """Remove recuo de 1ª linha e espaçamento antes/depois diretos, deixando valer o estilo Normal,
+    e grava o alinhamento (`jc`, se informado). Demais atributos (recuo esquerdo, entrelinha...) ficam.
+    O alinhamento fica no parágrafo e não no Normal, que também é base de cabeçalho, rodapé e notas.
+    """
+    if jc is not None:
+        p_elem.get_or_add_pPr().get_or_add_jc().set(_VAL_ATTR, jc)
+    pPr = p_elem.pPr
+    if pPr is None:
+        return
+    ind = pPr.ind
+    if ind is not None:
+        ind.attrib.pop(_FIRSTLINE_ATTR, None)
+        ind.attrib.pop(_HANGING_ATTR, None)
+        if not ind.attrib:
+            pPr._remove_ind()
+    spacing = pPr.spacing
+    if spacing is not None:
+        spacing.attrib.pop(_BEFORE_ATTR, None)
+        spacing.attrib.pop(_AFTER_ATTR, None)
+        if not spacing.attrib:
+            pPr._remove_spacing()
+    if len(pPr) == 0 and not pPr.attrib:
+        p_elem.remove(pPr)
+
+
+def _build_pPr(jc=None, first_line=None, left=None, right=None, line=None, line_rule='auto',
+               before=None, after=None):
+    """Monta um <w:pPr> modelo (medidas em twips) para ser copiado em vários parágrafos."""
+    pPr = OxmlElement('w:pPr')
+    if line is not None or before is not None or after is not None:
+        spacing = pPr.get_or_add_spacing()
+        for attr, val in (('w:before', before), ('w:after', after), ('w:line', line)):
+            if val is not None:
+                spacing.set(qn(attr), str(val))
+        if line is not None:
+            spacing.set(qn('w:lineRule'), line_rule)
+    if first_line is not None or left is not None or right is not None:
+        ind = pPr.get_or_add_ind()
+        for attr, val in (('w:left', left), ('w:right', right), ('w:firstLine', first_line)):
+            if val is not None:
+                ind.set(qn(attr), str(val))
+    if jc is not None:
+        pPr.get_or_add_jc().set(qn('w:val'), jc)
+    return pPr
+
+
+def _apply_pPr(p_elem, template) -> None:
+    """Troca no <w:pPr> do parágrafo os filhos presentes no modelo por cópias deles.
+    Os demais filhos (pStyle, numPr, sectPr...) ficam como estão.
+    """
+    pPr = p_elem.get_or_add_pPr()
+    for child in template:
+        # spacing/ind/jc: CT_PPr expõe _remove_<tag>/_insert_<tag>, que respeitam a ordem do schema
+        name = etree.QName(child).localname
+        getattr(pPr, '_remove_' + name)()
+        getattr(pPr, '_insert_' + name)(copy.deepcopy(child))
 
 
-def uppercase_heading_runs(paragraph):
-    for run in paragraph.runs:
-        run.text = run.text.upper()
+def _heading_names(style_names: dict) -> set:
+    return {n for n in style_names.values() if n.lower().startswith("heading")}
 
 
-def configure_heading_styles(doc: Document, h1_caps=True, h2_caps=True, h3_caps=True):
+def _caps_heading_names(h1_caps=True, h2_caps=True, h3_caps=True) -> set:
     heading_map = {"Heading 1": h1_caps, "Heading 2": h2_caps, "Heading 3": h3_caps}
-    for p in doc.paragraphs:
-        name = p.style.name if p.style is not None else ""
-        if name in heading_map and heading_map[name]:
-            uppercase_heading_runs(p)
-            p.alignment = WD_ALIGN_PARAGRAPH.LEFT
-            p.paragraph_format.first_line_indent = Cm(0)
+    return {name for name, on in heading_map.items() if on}
 
 
-def add_page_number_to_footer(doc: Document, position="right"):
-    for section in doc.sections:
-        footer = section.footer
-        para = footer.add_paragraph() if len(footer.paragraphs) == 0 else footer.paragraphs[0]
-        para.alignment = {
-            "center": WD_ALIGN_PARAGRAPH.CENTER,
-            "left": WD_ALIGN_PARAGRAPH.LEFT
-        }.get(position, WD_ALIGN_PARAGRAPH.RIGHT)
+def _uppercase_text(p_elem) -> None:
+    # Altera o texto dos <w:t> no lugar: o setter de Run.text recriaria os filhos do run (tabs, quebras)
+    for t in p_elem.iter(_T_TAG):
+        if t.text:
+            t.text = t.text.upper()
+
 
-        run = para.add_run()
-        fld_begin = OxmlElement('w:fldChar'); fld_begin.set(qn('w:fldCharType'), 'begin')
-        instr_text = OxmlElement('w:instrText'); instr_text.set(qn('xml:space'), 'preserve'); instr_text.text = ' PAGE '
-        fld_separate = OxmlElement('w:fldChar'); fld_separate.set(qn('w:fldCharType'), 'separate')
-        fld_end = OxmlElement('w:fldChar'); fld_end.set(qn('w:fldCharType'), 'end')
-        run._r.append(fld_begin); run._r.append(instr_text); run._r.append(fld_separate); run._r.append(fld_end)
+def _is_blank_p(p_elem, text: str, has_drawing: bool) -> bool:
+    # Sem texto, sem figura e sem quebra de seção (o sectPr mora no pPr do último parágrafo da seção)
+    return not (text.strip() or has_drawing or p_elem.find(_SECTPR) is not None)
 
 
 def remove_extra_blank_lines(doc: Document):
-    i = 0
-    while i < len(doc.paragraphs) - 1:
-        if not doc.paragraphs[i].text.strip() and not doc.paragraphs[i+1].text.strip():
-            try:
-                p = doc.paragraphs[i+1]._element
-                p.getparent().remove(p)
-                continue
-            except Exception:
-                pass
-        i += 1
+    # Vazios selecionados de uma vez no libxml2; remove cada um cujo bloco anterior (<w:p>/<w:tbl>,
+    # ignorando bookmarks etc.) também é vazio. Tabelas separam os vazios
+    body = doc.element.body
+    blank_ps = _BLANK_PS(body)
+    blank = set(blank_ps)
+    to_remove = [p for p in blank_ps
+                 if next(p.itersiblings(_P_TAG, _TBL_TAG, preceding=True), None) in blank]
+    for p in to_remove:
+        body.remove(p)
 
 # ----------
 # Tabelas
 # ----------
 
-def _set_row_cant_split(row):
-    # <w:trPr><w:cantSplit/></w:trPr>
-    tr = row._tr
-    trPr = tr.get_or_add_trPr()
-    cant = OxmlElement('w:cantSplit')
-    trPr.append(cant)
-
-
 def prevent_table_row_split_and_repeat_header(table):
     # Impede quebra de linha da linha na página seguinte e repete cabeçalho
-    for i, row in enumerate(table.rows):
-        _set_row_cant_split(row)
-        if i == 0:
-            trPr = row._tr.get_or_add_trPr()
-            hdr = OxmlElement('w:tblHeader')
-            trPr.append(hdr)
-    # Melhor legibilidade de largura (evita autofit extremo)
-    try:
-        tblPr = table._tbl.get_or_add_tblPr()
-        tblLayout = OxmlElement('w:tblLayout'); tblLayout.set(qn('w:type'), 'fixed')
-        tblPr.append(tblLayout)
-    except Exception:
-        pass
+    # <w:trPr><w:cantSplit/>[<w:tblHeader/>]</w:trPr>: um get_or_add por linha, filhos via SubElement
+    tbl = table._tbl
+    for i, tr in enumerate(tbl.iterchildren(_TR_TAG)):
+        trPr = tr.get_or_add_trPr()
+        if trPr.find(_CANTSPLIT_TAG) is None:
+            etree.SubElement(trPr, _CANTSPLIT_TAG)
+        if i == 0 and trPr.find(_TBLHEADER_TAG) is None:
+            etree.SubElement(trPr, _TBLHEADER_TAG)
 
 
-def center_paragraphs_with_drawings(doc: Document):
-    # Centraliza parágrafos que contêm imagens (desenhos)
-    for p in doc.paragraphs:
-        if p._element.xpath('.//w:drawing'):
-            p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            p.paragraph_format.first_line_indent = Cm(0)
-
 # ----------
 # Citações Longas (NBR 10520 – assistida)
 # ----------
@@ -173,36 +296,32 @@ def center_paragraphs_with_drawings(doc: Document):
 # O app converterá os parágrafos marcados em bloco com: recuo 4 cm, fonte 10 pt, espaçamento simples, sem aspas.
 
 
-def apply_long_quote_style(paragraph):
-    paragraph.paragraph_format.first_line_indent = Cm(0)
-    paragraph.paragraph_format.left_indent = Cm(4)
-    paragraph.paragraph_format.right_indent = Cm(0)
-    paragraph.paragraph_format.line_spacing = 1.0
-    paragraph.style.font.size = Pt(10) if paragraph.style and paragraph.style.font else None
-    paragraph.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
+def _strip_markers(paragraph, kinds) -> None:
+    """Remove os marcadores dos tipos em `kinds` direto nos nós <w:t>, sem recriar os runs (mantém negrito/itálico).
+    O casamento é feito no texto concatenado, então marcadores quebrados entre runs (comum após
+    edição no Word) também saem; só os <w:t> que o marcador cobre são reescritos.
+    """
+    ts = _W_T(paragraph._p)
+    texts = [t.text or '' for t in ts]
+    spans = [m.span() for m in _MARKER_RE.finditer(''.join(texts)) if m.group(2) in kinds]
+    pos = 0
+    for t, text in zip(ts, texts):
+        end = pos + len(text)
+        hit = [(a, b) for a, b in spans if a < end and b > pos]
+        if hit:
+            t.text = ''.join(c for i, c in enumerate(text, pos) if not any(a <= i < b for a, b in hit))
+        pos = end
 
 
-def process_long_quote_markers(doc: Document) -> int:
-    in_block = False
-    changed = 0
-    for p in doc.paragraphs:
-        txt = p.text
-        if '[[CITACAO_LONGA]]' in txt:
-            in_block = True
-            p.text = txt.replace('[[CITACAO_LONGA]]', '')
-            apply_long_quote_style(p)
-            changed += 1
-            continue
-        if '[[/CITACAO_LONGA]]' in txt:
-            in_block = False
-            p.text = txt.replace('[[/CITACAO_LONGA]]', '')
-            apply_long_quote_style(p)
-            changed += 1
-            continue
-        if in_block:
-            apply_long_quote_style(p)
-            changed += 1
-    return changed
+_LONG_QUOTE_PPR = _build_pPr(jc='both', first_line=0, left=Cm(4).twips, right=0, line=240, before=0, after=0)
+
+
+def apply_long_quote_style(paragraph):
+    _apply_pPr(paragraph._p, _LONG_QUOTE_PPR)
+    # Fonte 10 pt (w:sz em meios-pontos) em cada run do bloco, sem alterar o estilo compartilhado
+    for r in paragraph._p.iter(_R_TAG):
+        r.get_or_add_rPr().get_or_add_sz().set(_VAL_ATTR, '20')
+
 
 # ----------
 # Referências (NBR 6023 – assistidas)
@@ -210,39 +329,81 @@ def process_long_quote_markers(doc: Document) -> int:
 # Opção 1: marcar bloco de referências com [[REFERENCIAS]] ... [[/REFERENCIAS]] para aplicar recuo francês
 # Opção 2: utilizar gerador de referência por tipo (Livro, Artigo, Site)
 
-def apply_references_block_format(doc: Document, first_line_hanging_cm=1.25, line_spacing=1.0, space_between_pts=6):
-    in_refs = False
-    count = 0
-    for p in doc.paragraphs:
-        t = p.text
-        if '[[REFERENCIAS]]' in t:
-            in_refs = True
-            p.text = t.replace('[[REFERENCIAS]]', '')
-        elif '[[/REFERENCIAS]]' in t:
-            in_refs = False
-            p.text = t.replace('[[/REFERENCIAS]]', '')
-        if in_refs or '[[/REFERENCIAS]]' in t:
-            pf = p.paragraph_format
-            pf.first_line_indent = Cm(0)
-            pf.left_indent = Cm(first_line_hanging_cm)
-            pf.line_spacing = line_spacing
-            pf.space_after = Pt(space_between_pts)
-            p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-            count += 1
-    return count
+@functools.lru_cache(maxsize=16)
+def _reference_entry_values(first_line_hanging_cm: float, line_spacing: float, space_between_pts: float):
+    # (left, line, after) em twips, já como texto; mesmas conversões dos setters do python-docx
+    return (str(_cm(first_line_hanging_cm).twips),
+            str(Emu(line_spacing * Twips(240)).twips),
+            str(_pt(space_between_pts).twips))
+
+
+def apply_reference_entry_style(paragraph, first_line_hanging_cm=1.25, line_spacing=1.0, space_between_pts=6):
+    # Equivale a pf.first_line_indent/left_indent/line_spacing/space_after + alignment, num só acesso ao pPr
+    left, line, after = _reference_entry_values(first_line_hanging_cm, line_spacing, space_between_pts)
+    pPr = paragraph._p.get_or_add_pPr()
+    ind = pPr.get_or_add_ind()
+    ind.attrib.pop(_FIRSTLINE_ATTR, None)
+    ind.attrib.pop(_HANGING_ATTR, None)
+    ind.set(_FIRSTLINE_ATTR, '0')
+    ind.set(_LEFT_ATTR, left)
+    spacing = pPr.get_or_add_spacing()
+    spacing.set(_LINE_ATTR, line)
+    spacing.set(_LINERULE_ATTR, 'auto')
+    spacing.set(_AFTER_ATTR, after)
+    pPr.get_or_add_jc().set(_VAL_ATTR, 'both')
+
+
+def _marker_kinds(quotes=True, refs=True) -> set:
+    return {kind for kind, on in (('CITACAO_LONGA', quotes), ('REFERENCIAS', refs)) if on}
+
+
+def _scan_markers(text: str, kinds, in_quote: bool, in_refs: bool):
+    """Atualiza o estado dos blocos com os marcadores (dos tipos em `kinds`) presentes em `text`.
+    Retorna (in_quote, in_refs, quote_here, refs_here, has_marker); `*_here` diz se o parágrafo
+    pertence ao bloco, inclusive quando é ele que abre ou fecha.
+    """
+    quote_here, refs_here, has_marker = in_quote, in_refs, False
+    if '[[' not in text:
+        # Quase todo parágrafo cai aqui: dispensa a regex
+        return in_quote, in_refs, quote_here, refs_here, has_marker
+    for m in _MARKER_RE.finditer(text):
+        closing, kind = m.group(1), m.group(2)
+        if kind not in kinds:
+            continue
+        has_marker = True
+        if kind == 'CITACAO_LONGA':
+            in_quote, quote_here = not closing, True
+        else:
+            in_refs, refs_here = not closing, True
+    return in_quote, in_refs, quote_here, refs_here, has_marker
+
 
+# Modelos NBR 6023 montados uma vez; format_map só preenche os campos
+_FMT_LIVRO = "{sb}, {ini}. {titulo}.{ed} {local}: {editora}, {ano}."
+_FMT_ARTIGO = "{sb}, {ini}. {titulo}. {periodico}, v. {volume} {num}, p. {paginas}, {ano}."
+_FMT_SITE = "{autor}{titulo}. {site}. Disponível em: <{url}>. Acesso em: {acesso}.{ano}"
+
+@functools.lru_cache(maxsize=1024)
 def format_reference_livro(autor_sobrenome: str, autor_iniciais: str, titulo: str, ed: Optional[str], local: str, editora: str, ano: str):
-    ed_str = f" {ed}." if ed else "."
-    return f"{autor_sobrenome.upper()}, {autor_iniciais}. {titulo}.{ed_str} {local}: {editora}, {ano}."
+    return _FMT_LIVRO.format_map({
+        "sb": autor_sobrenome.upper(), "ini": autor_iniciais, "titulo": titulo,
+        "ed": f" {ed}." if ed else ".", "local": local, "editora": editora, "ano": ano,
+    })
 
+@functools.lru_cache(maxsize=1024)
 def format_reference_artigo(autor_sobrenome: str, autor_iniciais: str, titulo: str, periodico: str, volume: str, numero: Optional[str], paginas: str, ano: str):
-    num = f"({numero})" if numero else ""
-    return f"{autor_sobrenome.upper()}, {autor_iniciais}. {titulo}. {periodico}, v. {volume} {num}, p. {paginas}, {ano}."
+    return _FMT_ARTIGO.format_map({
+        "sb": autor_sobrenome.upper(), "ini": autor_iniciais, "titulo": titulo, "periodico": periodico,
+        "volume": volume, "num": f"({numero})" if numero else "", "paginas": paginas, "ano": ano,
+    })
 
+@functools.lru_cache(maxsize=1024)
 def format_reference_site(autor_sobrenome: Optional[str], autor_iniciais: Optional[str], titulo: str, site: str, url: str, acesso_data: str, ano: Optional[str]=None):
-    autor = f"{autor_sobrenome.upper()}, {autor_iniciais}. " if (autor_sobrenome and autor_iniciais) else ""
-    ano_str = f" {ano}." if ano else "."
-    return f"{autor}{titulo}. {site}. Disponível em: <{url}>. Acesso em: {acesso_data}.{ano_str}"
+    return _FMT_SITE.format_map({
+        "autor": f"{autor_sobrenome.upper()}, {autor_iniciais}. " if (autor_sobrenome and autor_iniciais) else "",
+        "titulo": titulo, "site": site, "url": url, "acesso": acesso_data,
+        "ano": f" {ano}." if ano else ".",
+    })
 
 # ----------
 # CAPA/FOLHA DE ROSTO (centralização via marcadores) e LISTAS (bullets) – ABNT
@@ -262,25 +423,25 @@ def center_block_by_markers(doc: Document, start_marker: str, end_marker: str) -
         if in_block or end_marker in t:
             p.alignment = WD_ALIGN_PARAGRAPH.CENTER
             pf = p.paragraph_format
-            pf.first_line_indent = Cm(0)
-            pf.left_indent = Cm(0)
-            pf.right_indent = Cm(0)
+            pf.first_line_indent = _ZERO_CM
+            pf.left_indent = _ZERO_CM
+            pf.right_indent = _ZERO_CM
             pf.line_spacing = 1.5
             count += 1
     return count
 
 def is_list_paragraph(p) -> bool:
-    return bool(p._p.xpath('.//w:numPr'))
+    return _HAS_NUMPR(p._p)
 
 def normalize_lists_abnt(doc: Document, left_indent_cm=1.25, hanging_cm=1.25, line_spacing=1.5):
     for p in doc.paragraphs:
         if is_list_paragraph(p):
             pf = p.paragraph_format
-            pf.left_indent = Cm(left_indent_cm)
-            pf.first_line_indent = Cm(-hanging_cm)
+            pf.left_indent = _cm(left_indent_cm)
+            pf.first_line_indent = _cm(-hanging_cm)
             pf.line_spacing = line_spacing
-            pf.space_before = Pt(0)
-            pf.space_after = Pt(0)
+            pf.space_before = _PT_0
+            pf.space_after = _PT_0
             p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
 
 # ----------
@@ -288,62 +449,118 @@ def normalize_lists_abnt(doc: Document, left_indent_cm=1.25, hanging_cm=1.25, li
 # ----------
 
 
-def add_caption_after_paragraph(doc: Document, p, text: str, italic=False):
-    """Insere um novo parágrafo LOGO APÓS `p` via OXML e retorna o Paragraph criado."""
-    new_p_el = OxmlElement('w:p')
-    p._p.addnext(new_p_el)
-    cap = None
-    for pp in doc.paragraphs:
-        if pp._p is new_p_el:
-            cap = pp; break
-    if cap is None:
-        return None
-    cap.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    cap.paragraph_format.first_line_indent = Cm(0)
-    r = cap.add_run(text)
-    if italic:
-        r.italic = True
-    return cap
+_CAPTION_PPR = {align: _build_pPr(jc=align, first_line=0) for align in ('center', 'left')}
+
+
+def _make_caption_p(text: str, align: str):
+    """Monta o <w:p> da legenda já completo (pPr + run), pronto para addprevious/addnext."""
+    p = OxmlElement('w:p')
+    p.append(copy.deepcopy(_CAPTION_PPR[align]))
+    r = etree.SubElement(p, _R_TAG)
+    t = etree.SubElement(r, _T_TAG)
+    t.text = text
+    if text != text.strip():
+        # Como o Run.text do python-docx: sem isso o Word descarta os espaços das pontas
+        t.set(_XML_SPACE_ATTR, 'preserve')
+    return p
 
 
 def ensure_captions(doc: Document, add_fig_captions: bool, add_tab_captions: bool):
     fig_n = 0
     tab_n = 0
-    for block in doc.element.body:
-        tag = block.tag
-        if tag.endswith('}p'):
-            p = next((pp for pp in doc.paragraphs if pp._p is block), None)
-            if p is not None and p._element.xpath('.//w:drawing'):
-                if add_fig_captions:
-                    fig_n += 1
-                    add_caption_after_paragraph(doc, p, f"Figura {fig_n} – Descrição da figura", italic=False)
-        elif tag.endswith('}tbl'):
-            tbl = next((t for t in doc.tables if t._tbl is block), None)
-            if tbl is not None:
-                prevent_table_row_split_and_repeat_header(tbl)
-                if add_tab_captions:
-                    # título acima
-                    new_p_above = OxmlElement('w:p')
-                    block.addprevious(new_p_above)
-                    p_obj_above = next((pp for pp in doc.paragraphs if pp._p is new_p_above), None)
-                    if p_obj_above:
-                        p_obj_above.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                        p_obj_above.paragraph_format.first_line_indent = Cm(0)
-                        p_obj_above.add_run(f"Tabela {tab_n+1} – Título da tabela")
-                    # fonte abaixo
-                    new_p_below = OxmlElement('w:p')
-                    block.addnext(new_p_below)
-                    p_obj_below = next((pp for pp in doc.paragraphs if pp._p is new_p_below), None)
-                    if p_obj_below:
-                        p_obj_below.alignment = WD_ALIGN_PARAGRAPH.LEFT
-                        p_obj_below.paragraph_format.first_line_indent = Cm(0)
-                        p_obj_below.add_run("Fonte: elaboração própria.")
-                    tab_n += 1
+    parent = doc._body
+    # Só <w:p> e <w:tbl>: o filtro por tag roda no libxml2 e pula sectPr, bookmarks etc.
+    # Legendas entram como <w:p> prontos; proxy python-docx só para as tabelas
+    for block in doc.element.body.iterchildren(_P_TAG, _TBL_TAG):
+        if block.tag == _P_TAG:
+            if add_fig_captions and _HAS_DRAWING(block):
+                fig_n += 1
+                block.addnext(_make_caption_p(f"Figura {fig_n} – Descrição da figura", 'center'))
+        else:
+            prevent_table_row_split_and_repeat_header(Table(block, parent))
+            if add_tab_captions:
+                # título acima, fonte abaixo
+                block.addprevious(_make_caption_p(f"Tabela {tab_n+1} – Título da tabela", 'center'))
+                block.addnext(_make_caption_p("Fonte: elaboração própria.", 'left'))
+                tab_n += 1
 
 # =====================
 # Pipeline principal
 # =====================
 
+def _walk_and_format(doc: Document, style_names: dict, justify=True, first_line_indent_cm=1.25,
+                     caps_names=frozenset(), center_images=True, format_refs=True) -> None:
+    """Formata os parágrafos do body numa única passada.
+    Cada <w:p> é classificado uma vez (estilo, figura, marcadores, lidos direto do XML):
+    figuras centralizadas, headings à esquerda e em caixa alta, corpo justificado com recuo,
+    blocos de citação longa e de referências formatados. Vazios repetidos são removidos ao final.
+    Parágrafos de corpo no estilo Normal (sem lista) só recebem o alinhamento direto: o recuo e
+    os espaçamentos vêm do estilo, já ajustado por configure_default_style.
+    """
+    body = doc.element.body
+    parent = doc._body
+    indent_twips = _cm(first_line_indent_cm).twips
+    body_jc = 'both' if justify else None
+    heading_names = _heading_names(style_names)
+    kinds = _marker_kinds(refs=format_refs)
+    in_quote = in_refs = prev_blank = False
+    # Marcadores do documento inteiro contados numa só leitura dos <w:t>: sem nenhum, a regex
+    # nunca roda. O texto concatenado pode juntar pedaços de parágrafos vizinhos, o que só superestima
+    markers_left = sum(1 for m in _MARKER_RE.finditer(_text_of(body)) if m.group(2) in kinds)
+    to_remove = []
+    # Passada serial de propósito: toda escrita é na mesma árvore lxml, que não aceita escrita
+    # concorrente, e SubElement/set não liberam o GIL (threads só somariam overhead).
+    for p_elem in body.iterchildren(_P_TAG, _TBL_TAG):
+        if p_elem.tag == _TBL_TAG:
+            prev_blank = False
+            continue
+        text = _text_of(p_elem)
+        has_drawing = bool(_HAS_DRAWING(p_elem))
+        p = None
+        if markers_left:
+            in_quote, in_refs, quote_here, refs_here, has_marker = _scan_markers(
+                text, kinds, in_quote, in_refs)
+            if has_marker:
+                markers_left -= sum(1 for m in _MARKER_RE.finditer(text) if m.group(2) in kinds)
+                # Marcadores saem antes do teste de vazio: um parágrafo só com o marcador vira vazio
+                p = Paragraph(p_elem, parent)
+                _strip_markers(p, kinds)
+                text = _text_of(p_elem)
+        else:
+            # Depois do último marcador só um bloco ainda aberto (sem fechamento) alcança parágrafos
+            quote_here, refs_here = in_quote, in_refs
+        blank = _is_blank_p(p_elem, text, has_drawing)
+        if blank and prev_blank:
+            to_remove.append(p_elem)
+            continue
+        prev_blank = blank
+
+        name = _style_name_of(p_elem, style_names)
+        if center_images and has_drawing:
+            _force_pPr(p_elem, 'center', 0)
+        elif name in heading_names:
+            _force_pPr(p_elem, 'left', 0)
+        elif name == "Normal" and p_elem.find(_NUMPR) is None:
+            _clear_direct_pPr(p_elem, body_jc)
+        else:
+            _force_pPr(p_elem, body_jc, indent_twips)
+        if name in caps_names:
+            _uppercase_text(p_elem)
+
+        if not (quote_here or refs_here):
+            continue
+        # Só parágrafos de bloco (raros) ganham proxy python-docx
+        if p is None:
+            p = Paragraph(p_elem, parent)
+        if quote_here:
+            apply_long_quote_style(p)
+        if refs_here:
+            apply_reference_entry_style(p)
+
+    for p_elem in to_remove:
+        body.remove(p_elem)
+
+
 def apply_abnt_formatting(doc: Document,
                           h1_caps=True,
                           h2_caps=True,
@@ -360,25 +577,18 @@ def apply_abnt_formatting(doc: Document,
                           normalize_bullets=True):
     set_page_margins(doc)
     configure_default_style(doc, line_spacing=1.5, first_line_indent_cm=first_line_indent_cm)
-    style_all_paragraphs(doc, justify=justify, first_line_indent_cm=first_line_indent_cm)
-    configure_heading_styles(doc, h1_caps=h1_caps, h2_caps=h2_caps, h3_caps=h3_caps)
 
-    if center_images:
-        center_paragraphs_with_drawings(doc)
-
-    # Tabelas: impedir quebra de linha e repetir cabeçalho; adicionar legendas (opcional)
-    for t in doc.tables:
-        prevent_table_row_split_and_repeat_header(t)
+    # Corpo, títulos, figuras, citações longas, referências e vazios repetidos: uma passada pelos parágrafos
+    _walk_and_format(doc, _paragraph_style_names(doc),
+                     justify=justify,
+                     first_line_indent_cm=first_line_indent_cm,
+                     caps_names=_caps_heading_names(h1_caps, h2_caps, h3_caps),
+                     center_images=center_images,
+                     format_refs=format_refs_block)
 
+    # Tabelas (impedir quebra de linha, repetir cabeçalho) e legendas opcionais: uma passada pelo body
     ensure_captions(doc, add_fig_captions=auto_captions_fig, add_tab_captions=auto_captions_tab)
 
-    # Citações longas via marcadores
-    process_long_quote_markers(doc)
-
-    # Bloco de referências formatado
-    if format_refs_block:
-        apply_references_block_format(doc)
-
     if footer_page_numbers:
         if page_numbers_from_intro:
             start_idx = _ensure_intro_section_and_get_start_index(doc)
@@ -387,9 +597,20 @@ def apply_abnt_formatting(doc: Document,
         else:
             add_page_number_to_footer(doc)
 
-    remove_extra_blank_lines(doc)
     return doc
 
+
+# Até este tamanho o ZIP gerado fica em memória; acima disso o SpooledTemporaryFile passa para disco
+_SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+
+def docx_to_bytes(doc: Document) -> bytes:
+    # Documentos grandes não crescem um BytesIO durante o save; st.download_button não aceita memoryview
+    with tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_BYTES) as out:
+        doc.save(out)
+        out.seek(0)
+        return out.read()
+
 # =====================
 # Funções para numeração a partir da Introdução
 # =====================
@@ -403,39 +624,41 @@ def _insert_section_break_before_paragraph(paragraph) -> None:
 
 
 def _ensure_intro_section_and_get_start_index(doc: Document, intro_terms=("introdução","introducao")) -> int:
-    intro_p = None
-    for p in doc.paragraphs:
-        if p.text and p.text.strip().lower() in intro_terms:
-            intro_p = p
-            break
+    # Para no primeiro acerto, sem montar a lista inteira de doc.paragraphs
+    intro_p = next((p for p in doc.element.body.iterchildren(_P_TAG)
+                    if _text_of(p).strip().lower() in intro_terms), None)
     if intro_p is None:
         return -1
-    _insert_section_break_before_paragraph(intro_p)
+    _insert_section_break_before_paragraph(Paragraph(intro_p, doc._body))
     return max(0, len(doc.sections) - 1)
 
 # =====================
-# Redefinição compatível: numeração com suporte a start_from_section
+# Numeração de páginas (campo PAGE no rodapé, com suporte a start_from_section)
 # =====================
 
 def add_page_number_to_footer(doc: Document, position="right", start_from_section: int = 0):
     """Adiciona campo PAGE ao rodapé a partir do índice de seção informado.
     Compatível com chamadas antigas (sem o parâmetro). Seções anteriores ficam sem exibição do número.
     """
+    alignment = {
+        "center": WD_ALIGN_PARAGRAPH.CENTER,
+        "left": WD_ALIGN_PARAGRAPH.LEFT
+    }.get(position, WD_ALIGN_PARAGRAPH.RIGHT)
     for i, section in enumerate(doc.sections):
         if i < start_from_section:
             continue
         footer = section.footer
         para = footer.add_paragraph() if len(footer.paragraphs) == 0 else footer.paragraphs[0]
-        para.alignment = {
-            "center": WD_ALIGN_PARAGRAPH.CENTER,
-            "left": WD_ALIGN_PARAGRAPH.LEFT
-        }.get(position, WD_ALIGN_PARAGRAPH.RIGHT)
-        run = para.add_run()
-        fld_begin = OxmlElement('w:fldChar'); fld_begin.set(qn('w:fldCharType'), 'begin')
-        instr_text = OxmlElement('w:instrText'); instr_text.set(qn('xml:space'), 'preserve'); instr_text.text = ' PAGE '
-        fld_separate = OxmlElement('w:fldChar'); fld_separate.set(qn('w:fldCharType'), 'separate')
-        fld_end = OxmlElement('w:fldChar'); fld_end.set(qn('w:fldCharType'), 'end')
-        run._r.append(fld_begin); run._r.append(instr_text); run._r.append(fld_separate); run._r.append(fld_end)
+        para.alignment = alignment
+        # begin / instrText PAGE / separate / end: montados soltos e anexados ao run de uma vez
+        r = para.add_run()._r
+        make = r.makeelement
+        instr = make(_INSTRTEXT_TAG, {_XML_SPACE_ATTR: 'preserve'})
+        instr.text = ' PAGE '
+        r.extend((make(_FLDCHAR_TAG, {_FLDCHARTYPE_ATTR: 'begin'}),
+                  instr,
+                  make(_FLDCHAR_TAG, {_FLDCHARTYPE_ATTR: 'separate'}),
+                  make(_FLDCHAR_TAG, {_FLDCHARTYPE_ATTR: 'end'})))
 
 # =====================
 # Streamlit UI
@@ -469,492 +692,18 @@ st.markdown(
     """
 )
 
-uploaded = st.file_uploader("Envie seu arquivo .docx", type=["docx"]) 
-
-if uploaded is not None:
-    try:
-        doc = Document(uploaded)
-    except Exception as e:
-        st.error(f"Erro ao abrir DOCX: {e}")
-        st.stop()
-
-    st.info("Clique em **Aplicar ABNT** para processar. Você poderá baixar o DOCX formatado.")
+@st.cache_resource(max_entries=4)
+def _load_doc(file_key: tuple, _docx_bytes: bytes) -> Document:
+    # Parse cacheado entre reruns pela chave do upload (file_id, size): o Streamlit não faz hash
+    # dos bytes (parâmetro com "_"). O objeto é compartilhado, então formate sempre uma cópia
+    return Document(io.BytesIO(_docx_bytes))
 
-    if st.button("✨ Aplicar ABNT"):
-        try:
-            formatted = apply_abnt_formatting(
-                doc,
-                h1_caps=do_h1,
-                h2_caps=do_h2,
-                h3_caps=do_h3,
-                justify=do_justify,
-                footer_page_numbers=do_pagenum,
-                first_line_indent_cm=float(first_indent),
-                center_images=center_imgs,
-                auto_captions_fig=auto_fig,
-                auto_captions_tab=auto_tab,
-                format_refs_block=refs_block,
-                page_numbers_from_intro=from_intro,
-            )
-            out = io.BytesIO(); formatted.save(out); out.seek(0)
-            base_name = uploaded.name.replace('.docx', '').replace('.DOCX', '')
-            st.success("Arquivo formatado com sucesso!")
-            st.download_button(
-                label="⬇️ Baixar DOCX formatado",
-                data=out,
-                file_name=f"{base_name}_ABNT.docx",
-                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-            )
-            st.caption("Dica: revise capa/folha de rosto, listas pré-textuais e sumário no Word/LibreOffice e exporte para PDF.")
-        except Exception as e:
-            st.error(f"Falha ao formatar: {e}")
-
-st.divider()
-
-st.subheader("Cobertura desta automação")
-st.markdown(
-    """
-**Layout geral (NBR 14724):**
-- **Margens**: 3 cm (superior/esquerda) e 2 cm (direita/inferior)
-- **Fonte**: Times New Roman, 12 pt (texto)
-- **Parágrafos**: 1,5; sem espaços extras; **recuo 1,25 cm**; justificado (opcional)
-- **Títulos (Heading 1/2/3)**: caixa alta opcional; esquerda; sem recuo
-- **Páginas**: numeração no rodapé (direita) com campo automático `PAGE`
-
-**Tabelas e Figuras:**
-- **Tabelas**: impede que a **linha quebre entre páginas** e repete **cabeçalho**; opção de **Título acima** e **Fonte abaixo** (placeholders).
-- **Figuras**: centraliza parágrafo com imagem; opção de **Legenda abaixo** numerada (placeholder).
-
-**Citações (NBR 10520):**
-- **Citação curta**: siga no corpo entre aspas (até ~3 linhas) – revisão manual.
-- **Citação longa**: use os marcadores `[[CITACAO_LONGA]] ... [[/CITACAO_LONGA]]` para aplicar bloco ABNT.
-
-**Referências (NBR 6023):**
-- Use `[[REFERENCIAS]] ... [[/REFERENCIAS]]` para aplicar **recuo francês**, espaçamento simples e espaço entre entradas.
-- Abaixo, há um **gerador de referência** para formatos comuns (Livro, Artigo, Site) — cole o resultado no bloco de referências do seu DOCX.
-    """
-)
-
-st.subheader("Gerador rápido de referências (NBR 6023 – básico)")
-ref_tipo = st.selectbox("Tipo", ["Livro", "Artigo", "Site"]) 
-if ref_tipo == "Livro":
-    c1, c2 = st.columns(2)
-    with c1:
-        sb = st.text_input("SOBRENOME do autor", "SILVA")
-        ini = st.text_input("Iniciais", "J. P.")
-        titulo = st.text_input("Título", "Métodos de pesquisa")
-        ed = st.text_input("Edição (ex.: 2. ed.)", "")
-    with c2:
-        local = st.text_input("Local", "São Paulo")
-        edit = st.text_input("Editora", "Atlas")
-        ano = st.text_input("Ano", "2020")
-    if st.button("Gerar referência (Livro)"):
-        st.code(format_reference_livro(sb, ini, titulo, ed, local, edit, ano))
-elif ref_tipo == "Artigo":
-    c1, c2 = st.columns(2)
-    with c1:
-        sb = st.text_input("SOBRENOME do autor", "PEREIRA")
-        ini = st.text_input("Iniciais", "M. A.")
-        titulo = st.text_input("Título do artigo", "Sono e memória")
-        period = st.text_input("Periódico", "Revista de Psicologia")
-    with c2:
-        vol = st.text_input("Volume", "37")
-        num = st.text_input("Número (opcional)", "1")
-        pags = st.text_input("Páginas", "63–76")
-        ano = st.text_input("Ano", "2017")
-    if st.button("Gerar referência (Artigo)"):
-        st.code(format_reference_artigo(sb, ini, titulo, period, vol, num, pags, ano))
-else:
-    c1, c2 = st.columns(2)
-    with c1:
-        sb = st.text_input("SOBRENOME do autor (opcional)", "")
-        ini = st.text_input("Iniciais (opcional)", "")
-        titulo = st.text_input("Título da página", "Atendimento de Saúde Mental")
-    with c2:
-        site = st.text_input("Site", "Prefeitura de São José do Rio Preto")
-        url = st.text_input("URL", "https://www.riopreto.sp.gov.br/cartaservicos/saude/atendimento-de-saude-mental-para-alcool-e-outras-drogas")
-        acesso = st.text_input("Acesso em (DD MMM. AAAA)", "3 nov. 2025")
-        ano = st.text_input("Ano (opcional)", "")
-    if st.button("Gerar referência (Site)"):
-        st.code(format_reference_site(sb if sb else None, ini if ini else None, titulo, site, url, acesso, ano if ano else None))
-
-st.caption("💡 Dica: mantenha títulos como Heading 1/2/3 no Word; use marcadores para citações longas e referências; revise manualmente capas/sumários.")
-"""
-Streamlit ABNT Formatter (DOCX → DOCX)
---------------------------------------
-- Aplica formatação ABNT em .docx e permite baixar o resultado.
-- Foco: **NBR 14724** (margens, fonte, espaçamento, recuo, alinhamento, numeração) + **tabelas/figuras/citações longas** e **Referências (NBR 6023) – modo assistido**.
-
-Como rodar (local):
-1) pip install -r requirements.txt
-2) streamlit run app.py
-
-requirements.txt:
-------------------
-streamlit
-python-docx
-lxml
-
-Notas:
-- O app não exporta PDF (faça no Word/LibreOffice após download).
-- "Citação longa" e "Referências NBR 6023" têm muita nuance: oferecemos **marcação assistida** e **templates**.
-"""
-
-import io
-from typing import Optional, List, Tuple
-import re
-import streamlit as st
-from docx import Document
-from docx.shared import Cm, Pt
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.oxml import OxmlElement
-from docx.oxml.ns import qn
-
-# =====================
-# ABNT Helper Functions
-# =====================
-
-def set_page_margins(doc: Document, top_cm=3.0, left_cm=3.0, right_cm=2.0, bottom_cm=2.0):
-    for section in doc.sections:
-        section.top_margin = Cm(top_cm)
-        section.left_margin = Cm(left_cm)
-        section.right_margin = Cm(right_cm)
-        section.bottom_margin = Cm(bottom_cm)
-
-
-def configure_default_style(doc: Document, font_name="Times New Roman", font_size_pt=12, line_spacing=1.5,
-                            first_line_indent_cm=1.25, justify=True):
-    normal = doc.styles["Normal"]
-    normal.font.name = font_name
-    normal.font.size = Pt(font_size_pt)
-    pf = normal.paragraph_format
-    pf.line_spacing = line_spacing
-    pf.space_before = Pt(0)
-    pf.space_after = Pt(0)
-    pf.first_line_indent = Cm(first_line_indent_cm)
-
-
-def style_all_paragraphs(doc: Document, justify=True, first_line_indent_cm=1.25):
-    for p in doc.paragraphs:
-        text = p.text.strip()
-        # Headings: alinhar à esquerda, sem recuo
-        if p.style and p.style.name.lower().startswith("heading"):
-            p.alignment = WD_ALIGN_PARAGRAPH.LEFT
-            p.paragraph_format.first_line_indent = Cm(0)
-            p.paragraph_format.space_before = Pt(0)
-            p.paragraph_format.space_after = Pt(0)
-        else:
-            if justify:
-                p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-            p.paragraph_format.first_line_indent = Cm(first_line_indent_cm)
-            p.paragraph_format.space_before = Pt(0)
-            p.paragraph_format.space_after = Pt(0)
-
-
-def uppercase_heading_runs(paragraph):
-    for run in paragraph.runs:
-        run.text = run.text.upper()
-
-
-def configure_heading_styles(doc: Document, h1_caps=True, h2_caps=True, h3_caps=True):
-    heading_map = {"Heading 1": h1_caps, "Heading 2": h2_caps, "Heading 3": h3_caps}
-    for p in doc.paragraphs:
-        name = p.style.name if p.style is not None else ""
-        if name in heading_map and heading_map[name]:
-            uppercase_heading_runs(p)
-            p.alignment = WD_ALIGN_PARAGRAPH.LEFT
-            p.paragraph_format.first_line_indent = Cm(0)
-
-
-def add_page_number_to_footer(doc: Document, position="right"):
-    for section in doc.sections:
-        footer = section.footer
-        para = footer.add_paragraph() if len(footer.paragraphs) == 0 else footer.paragraphs[0]
-        para.alignment = {
-            "center": WD_ALIGN_PARAGRAPH.CENTER,
-            "left": WD_ALIGN_PARAGRAPH.LEFT
-        }.get(position, WD_ALIGN_PARAGRAPH.RIGHT)
-
-        run = para.add_run()
-        fld_begin = OxmlElement('w:fldChar'); fld_begin.set(qn('w:fldCharType'), 'begin')
-        instr_text = OxmlElement('w:instrText'); instr_text.set(qn('xml:space'), 'preserve'); instr_text.text = ' PAGE '
-        fld_separate = OxmlElement('w:fldChar'); fld_separate.set(qn('w:fldCharType'), 'separate')
-        fld_end = OxmlElement('w:fldChar'); fld_end.set(qn('w:fldCharType'), 'end')
-        run._r.append(fld_begin); run._r.append(instr_text); run._r.append(fld_separate); run._r.append(fld_end)
-
-
-def remove_extra_blank_lines(doc: Document):
-    i = 0
-    while i < len(doc.paragraphs) - 1:
-        if not doc.paragraphs[i].text.strip() and not doc.paragraphs[i+1].text.strip():
-            try:
-                p = doc.paragraphs[i+1]._element
-                p.getparent().remove(p)
-                continue
-            except Exception:
-                pass
-        i += 1
-
-# ----------
-# Tabelas
-# ----------
-
-def _set_row_cant_split(row):
-    # <w:trPr><w:cantSplit/></w:trPr>
-    tr = row._tr
-    trPr = tr.get_or_add_trPr()
-    cant = OxmlElement('w:cantSplit')
-    trPr.append(cant)
-
-
-def prevent_table_row_split_and_repeat_header(table):
-    # Impede quebra de linha da linha na página seguinte e repete cabeçalho
-    for i, row in enumerate(table.rows):
-        _set_row_cant_split(row)
-        if i == 0:
-            trPr = row._tr.get_or_add_trPr()
-            hdr = OxmlElement('w:tblHeader')
-            trPr.append(hdr)
-    # Melhor legibilidade de largura (evita autofit extremo)
-    try:
-        tblPr = table._tbl.get_or_add_tblPr()
-        tblLayout = OxmlElement('w:tblLayout'); tblLayout.set(qn('w:type'), 'fixed')
-        tblPr.append(tblLayout)
-    except Exception:
-        pass
-
-
-def center_paragraphs_with_drawings(doc: Document):
-    # Centraliza parágrafos que contêm imagens (desenhos)
-    for p in doc.paragraphs:
-        if p._element.xpath('.//w:drawing'):
-            p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            p.paragraph_format.first_line_indent = Cm(0)
-
-# ----------
-# Citações Longas (NBR 10520 – assistida)
-# ----------
-# Marcadores no texto: [[CITACAO_LONGA]] ... [[/CITACAO_LONGA]]
-# O app converterá os parágrafos marcados em bloco com: recuo 4 cm, fonte 10 pt, espaçamento simples, sem aspas.
-
-
-def apply_long_quote_style(paragraph):
-    paragraph.paragraph_format.first_line_indent = Cm(0)
-    paragraph.paragraph_format.left_indent = Cm(4)
-    paragraph.paragraph_format.right_indent = Cm(0)
-    paragraph.paragraph_format.line_spacing = 1.0
-    paragraph.style.font.size = Pt(10) if paragraph.style and paragraph.style.font else None
-    paragraph.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-
-
-def process_long_quote_markers(doc: Document) -> int:
-    in_block = False
-    changed = 0
-    for p in doc.paragraphs:
-        txt = p.text
-        if '[[CITACAO_LONGA]]' in txt:
-            in_block = True
-            p.text = txt.replace('[[CITACAO_LONGA]]', '')
-            apply_long_quote_style(p)
-            changed += 1
-            continue
-        if '[[/CITACAO_LONGA]]' in txt:
-            in_block = False
-            p.text = txt.replace('[[/CITACAO_LONGA]]', '')
-            apply_long_quote_style(p)
-            changed += 1
-            continue
-        if in_block:
-            apply_long_quote_style(p)
-            changed += 1
-    return changed
-
-# ----------
-# Referências (NBR 6023 – assistidas)
-# ----------
-# Opção 1: marcar bloco de referências com [[REFERENCIAS]] ... [[/REFERENCIAS]] para aplicar recuo francês
-# Opção 2: utilizar gerador de referência por tipo (Livro, Artigo, Site)
-
-
-def apply_references_block_format(doc: Document, first_line_hanging_cm=1.25, line_spacing=1.0, space_between_pts=6):
-    in_refs = False
-    count = 0
-    for p in doc.paragraphs:
-        t = p.text
-        if '[[REFERENCIAS]]' in t:
-            in_refs = True
-            p.text = t.replace('[[REFERENCIAS]]', '')
-        elif '[[/REFERENCIAS]]' in t:
-            in_refs = False
-            p.text = t.replace('[[/REFERENCIAS]]', '')
-        if in_refs or '[[/REFERENCIAS]]' in t:
-            pf = p.paragraph_format
-            pf.first_line_indent = Cm(0)
-            pf.left_indent = Cm(first_line_hanging_cm)
-            pf.line_spacing = line_spacing
-            pf.space_after = Pt(space_between_pts)
-            p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-            count += 1
-    return count
-
-
-def format_reference_livro(autor_sobrenome: str, autor_iniciais: str, titulo: str, ed: Optional[str], local: str, editora: str, ano: str):
-    # SOBRENOME, Iniciais. Título: subtítulo. ed. Local: Editora, ano.
-    ed_str = f" {ed}." if ed else "."
-    return f"{autor_sobrenome.upper()}, {autor_iniciais}. {titulo}.{ed_str} {local}: {editora}, {ano}."
-
-
-def format_reference_artigo(autor_sobrenome: str, autor_iniciais: str, titulo: str, periodico: str, volume: str, numero: Optional[str], paginas: str, ano: str):
-    num = f"({numero})" if numero else ""
-    return f"{autor_sobrenome.upper()}, {autor_iniciais}. {titulo}. {periodico}, v. {volume} {num}, p. {paginas}, {ano}."
-
-
-def format_reference_site(autor_sobrenome: Optional[str], autor_iniciais: Optional[str], titulo: str, site: str, url: str, acesso_data: str, ano: Optional[str]=None):
-    autor = f"{autor_sobrenome.upper()}, {autor_iniciais}. " if (autor_sobrenome and autor_iniciais) else ""
-    ano_str = f" {ano}." if ano else "."
-    return f"{autor}{titulo}. {site}. Disponível em: <{url}>. Acesso em: {acesso_data}.{ano_str}"
-
-# ----------
-# Figuras (centralizar e legenda abaixo) e Tabelas (título acima, fonte abaixo)
-# ----------
-
-
-def add_caption_after_paragraph(p, text: str, italic=False):
-    cap = p.insert_paragraph_after(text)
-    cap.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    cap.paragraph_format.first_line_indent = Cm(0)
-    if italic and cap.runs:
-        cap.runs[0].italic = True
-    return cap
-
-
-def ensure_captions(doc: Document, add_fig_captions: bool, add_tab_captions: bool):
-    fig_n = 0
-    tab_n = 0
-    for block in doc.element.body:
-        tag = block.tag
-        if tag.endswith('}p'):
-            p = next((pp for pp in doc.paragraphs if pp._p is block), None)
-            if p is not None and p._element.xpath('.//w:drawing'):
-                # imagem encontrada
-                if add_fig_captions:
-                    fig_n += 1
-                    add_caption_after_paragraph(p, f"Figura {fig_n} – Descrição da figura", italic=False)
-        elif tag.endswith('}tbl'):
-            # tabela encontrada
-            tbl = next((t for t in doc.tables if t._tbl is block), None)
-            if tbl is not None:
-                prevent_table_row_split_and_repeat_header(tbl)
-                if add_tab_captions:
-                    # Título acima e fonte abaixo (placeholder)
-                    # Inserir título acima
-                    first_p = doc.paragraphs[0]
-                    new_p_above = first_p._element.__class__('w:p')
-                    block.addprevious(new_p_above)
-                    p_obj_above = None
-                    for pp in doc.paragraphs:
-                        if pp._p is new_p_above:
-                            p_obj_above = pp; break
-                    if p_obj_above:
-                        p_obj_above.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                        p_obj_above.paragraph_format.first_line_indent = Cm(0)
-                        p_obj_above.add_run(f"Tabela {tab_n+1} – Título da tabela")
-                    # Fonte abaixo
-                    new_p_below = first_p._element.__class__('w:p')
-                    block.addnext(new_p_below)
-                    p_obj_below = None
-                    for pp in doc.paragraphs:
-                        if pp._p is new_p_below:
-                            p_obj_below = pp; break
-                    if p_obj_below:
-                        p_obj_below.alignment = WD_ALIGN_PARAGRAPH.LEFT
-                        p_obj_below.paragraph_format.first_line_indent = Cm(0)
-                        p_obj_below.add_run("Fonte: elaboração própria.")
-                    tab_n += 1
-
-# =====================
-# Pipeline principal
-# =====================
-
-def apply_abnt_formatting(doc: Document,
-                          h1_caps=True,
-                          h2_caps=True,
-                          h3_caps=True,
-                          justify=True,
-                          footer_page_numbers=True,
-                          first_line_indent_cm=1.25,
-                          center_images=True,
-                          auto_captions_fig=True,
-                          auto_captions_tab=True,
-                          format_refs_block=True):
-    set_page_margins(doc)
-    configure_default_style(doc, line_spacing=1.5, first_line_indent_cm=first_line_indent_cm)
-    style_all_paragraphs(doc, justify=justify, first_line_indent_cm=first_line_indent_cm)
-    configure_heading_styles(doc, h1_caps=h1_caps, h2_caps=h2_caps, h3_caps=h3_caps)
-
-    if center_images:
-        center_paragraphs_with_drawings(doc)
-
-    # Tabelas: impedir quebra de linha e repetir cabeçalho; adicionar legendas (opcional)
-    for t in doc.tables:
-        prevent_table_row_split_and_repeat_header(t)
-
-    ensure_captions(doc, add_fig_captions=auto_captions_fig, add_tab_captions=auto_captions_tab)
-
-    # Citações longas via marcadores
-    process_long_quote_markers(doc)
-
-    # Bloco de referências formatado
-    if format_refs_block:
-        apply_references_block_format(doc)
-
-    if footer_page_numbers:
-        if page_numbers_from_intro:
-            start_idx = _ensure_intro_section_and_get_start_index(doc)
-            start_idx = 0 if start_idx == -1 else start_idx
-            add_page_number_to_footer(doc, start_from_section=start_idx)
-        else:
-            add_page_number_to_footer(doc)
-
-    remove_extra_blank_lines(doc)
-    return doc
-
-# =====================
-# Streamlit UI
-# =====================
-
-st.set_page_config(page_title="ABNT Formatter (DOCX)", page_icon="📄", layout="centered")
-
-st.title("📄 Automatizador ABNT para DOCX – Completo")
-st.caption("Margens, fonte, parágrafos, títulos, numeração, **tabelas**, **figuras**, **citações longas** e **Referências (assistido)**.")
-
-with st.expander("⚙️ Opções de formatação", expanded=True):
-    col1, col2 = st.columns(2)
-    with col1:
-        do_h1 = st.checkbox("TÍTULOS NÍVEL 1 EM CAIXA ALTA", value=True)
-        do_h2 = st.checkbox("TÍTULOS NÍVEL 2 EM CAIXA ALTA", value=True)
-        do_h3 = st.checkbox("TÍTULOS NÍVEL 3 EM CAIXA ALTA", value=True)
-        do_justify = st.checkbox("Justificar parágrafos", value=True)
-        first_indent = st.number_input("Recuo da 1ª linha (cm)", min_value=0.0, max_value=3.0, value=1.25, step=0.25)
-    with col2:
-        do_pagenum = st.checkbox("Inserir número de página no rodapé (direita)", value=True)
-        center_imgs = st.checkbox("Centralizar imagens (parágrafos com figuras)", value=True)
-        auto_fig = st.checkbox("Adicionar legenda abaixo das figuras (placeholder)", value=False)
-        auto_tab = st.checkbox("Adicionar título acima e fonte abaixo das tabelas (placeholder)", value=False)
-        refs_block = st.checkbox("Formatar bloco de referências (recuo francês)", value=True)
-
-st.markdown(
-    """**Marcadores úteis no texto do DOCX** (opcionais):
-- `[[CITACAO_LONGA]] ... [[/CITACAO_LONGA]]` → aplica NBR 10520: recuo 4 cm, fonte ~10 pt, espaçamento simples, sem aspas.
-- `[[REFERENCIAS]] ... [[/REFERENCIAS]]` → aplica recuo francês, espaçamento simples e espaço entre entradas.
-    """
-)
 
 uploaded = st.file_uploader("Envie seu arquivo .docx", type=["docx"]) 
 
 if uploaded is not None:
     try:
-        doc = Document(uploaded)
+        source_doc = _load_doc((uploaded.file_id, uploaded.size), uploaded.getvalue())
     except Exception as e:
         st.error(f"Erro ao abrir DOCX: {e}")
         st.stop()
@@ -964,7 +713,7 @@ if uploaded is not None:
     if st.button("✨ Aplicar ABNT"):
         try:
             formatted = apply_abnt_formatting(
-                doc,
+                copy.deepcopy(source_doc),
                 h1_caps=do_h1,
                 h2_caps=do_h2,
                 h3_caps=do_h3,
@@ -975,13 +724,18 @@ if uploaded is not None:
                 auto_captions_fig=auto_fig,
                 auto_captions_tab=auto_tab,
                 format_refs_block=refs_block,
+                page_numbers_from_intro=from_intro,
             )
-            out = io.BytesIO(); formatted.save(out); out.seek(0)
+            data = docx_to_bytes(formatted)
+            # A árvore formatada não é mais usada: libera antes de o download guardar sua cópia dos bytes
+            # (as partes do python-docx têm referências circulares, daí o collect)
+            del formatted
+            gc.collect()
             base_name = uploaded.name.replace('.docx', '').replace('.DOCX', '')
             st.success("Arquivo formatado com sucesso!")
             st.download_button(
                 label="⬇️ Baixar DOCX formatado",
-                data=out,
+                data=data,
                 file_name=f"{base_name}_ABNT.docx",
                 mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
             )
@@ -1059,9 +813,3 @@ else:
         st.code(format_reference_site(sb if sb else None, ini if ini else None, titulo, site, url, acesso, ano if ano else None))
 
 st.caption("💡 Dica: mantenha títulos como Heading 1/2/3 no Word; use marcadores para citações longas e referências; revise manualmente capas/sumários.")
-
-
-st.caption("💡 Dica: mantenha títulos como Heading 1/2/3 no Word; use marcadores para citações longas e referências; revise manualmente capas/sumários.")
-
-
-
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# abnt.py fica na raiz do repositório (app Streamlit de arquivo único)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,238 @@
+from docx import Document
+from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+from docx.shared import Cm, Pt
+
+import abnt
+
+
+def _add_deleted_run(paragraph, text):
+    # <w:del><w:r><w:delText>: texto excluído com controle de alterações
+    dele = OxmlElement('w:del')
+    dele.set(qn('w:id'), '1')
+    dele.set(qn('w:author'), 'Revisor')
+    r = OxmlElement('w:r')
+    del_text = OxmlElement('w:delText')
+    del_text.text = text
+    r.append(del_text)
+    dele.append(r)
+    paragraph._p.append(dele)
+    return del_text
+
+
+def test_tables_keep_autofit_layout():
+    doc = Document()
+    doc.add_paragraph("Antes da tabela.")
+    doc.add_table(rows=2, cols=2)
+    abnt.apply_abnt_formatting(doc, auto_captions_tab=False)
+
+    tbl = doc.tables[0]._tbl
+    assert tbl.tblPr.find(qn('w:tblLayout')) is None
+    rows = list(tbl.iterchildren(qn('w:tr')))
+    assert all(tr.trPr.find(qn('w:cantSplit')) is not None for tr in rows)
+    assert rows[0].trPr.find(qn('w:tblHeader')) is not None
+
+
+def test_marker_only_paragraph_counts_as_blank():
+    doc = Document()
+    for text in ['Texto final do capítulo.', '', '[[REFERENCIAS]]', 'SILVA, J. Livro. 2020.',
+                 '[[/REFERENCIAS]]', '', 'Fim.']:
+        doc.add_paragraph(text)
+    abnt.apply_abnt_formatting(doc, auto_captions_tab=False)
+
+    assert [p.text for p in doc.paragraphs] == [
+        'Texto final do capítulo.', '', 'SILVA, J. Livro. 2020.', '', 'Fim.']
+
+
+def test_justify_stays_on_body_paragraphs():
+    doc = Document()
+    doc.add_paragraph("Corpo do texto.")
+    doc.sections[0].header.paragraphs[0].text = "Cabeçalho"
+    abnt.apply_abnt_formatting(doc, auto_captions_tab=False)
+
+    # O Normal também é base de cabeçalho, rodapé e notas: o alinhamento não vai para o estilo
+    assert doc.styles['Normal'].paragraph_format.alignment is None
+    assert doc.sections[0].header.paragraphs[0].alignment is None
+    assert doc.paragraphs[0].alignment == WD_ALIGN_PARAGRAPH.JUSTIFY
+    assert doc.paragraphs[0].paragraph_format.first_line_indent is None
+
+
+def test_unicode_spaces_count_as_blank():
+    doc = Document()
+    for text in ['Antes.', '', '\u2003', '\u3000\u2009', '\u00a0', 'Depois.']:
+        doc.add_paragraph(text)
+    abnt.remove_extra_blank_lines(doc)
+
+    assert [p.text for p in doc.paragraphs] == ['Antes.', '', 'Depois.']
+
+
+def test_default_style_accepts_on_value():
+    doc = Document()
+    normal = doc.styles['Normal'].element
+    normal.set(qn('w:default'), 'on')
+
+    assert abnt._paragraph_style_names(doc)[None] == 'Normal'
+
+
+def test_tracked_deleted_marker_is_ignored():
+    doc = Document()
+    p = doc.add_paragraph("Texto mantido.")
+    del_text = _add_deleted_run(p, '[[CITACAO_LONGA]]')
+    doc.add_paragraph("Parágrafo seguinte.")
+    abnt.apply_abnt_formatting(doc, auto_captions_tab=False)
+
+    # Marcador excluído com controle de alterações não abre bloco de citação longa
+    assert del_text.text == '[[CITACAO_LONGA]]'
+    after = doc.paragraphs[1]
+    assert after.paragraph_format.left_indent is None
+    assert all(run.font.size is None for run in after.runs)
+
+
+def test_intro_lookup_skips_tracked_deleted_heading():
+    doc = Document()
+    deleted = doc.add_paragraph()
+    _add_deleted_run(deleted, 'INTRODUÇÃO')
+    intro = doc.add_paragraph('Introdução')
+
+    assert abnt._ensure_intro_section_and_get_start_index(doc) == 1
+    assert deleted._p.find(qn('w:pPr') + '/' + qn('w:sectPr')) is None
+    assert intro._p.find(qn('w:pPr') + '/' + qn('w:sectPr')) is not None
+
+
+def _formatted(texts, **kwargs):
+    doc = Document()
+    for text in texts:
+        doc.add_paragraph(text)
+    kwargs.setdefault('auto_captions_tab', False)
+    abnt.apply_abnt_formatting(doc, **kwargs)
+    return doc
+
+
+def test_page_margins_in_twips():
+    doc = _formatted(['Texto.'])
+
+    pgMar = doc.sections[0]._sectPr.pgMar
+    # 3 cm em cima e à esquerda, 2 cm embaixo e à direita (1 cm = 567 twips)
+    assert (pgMar.get(qn('w:top')), pgMar.get(qn('w:left'))) == ('1701', '1701')
+    assert (pgMar.get(qn('w:bottom')), pgMar.get(qn('w:right'))) == ('1134', '1134')
+    assert doc.sections[0].top_margin.twips == Cm(3).twips
+
+
+def test_body_paragraphs_get_abnt_format():
+    doc = Document()
+    doc.add_paragraph('Corpo no estilo Normal.')
+    doc.add_paragraph('Corpo em outro estilo.', style='Body Text')
+    abnt.apply_abnt_formatting(doc, auto_captions_tab=False)
+
+    normal = doc.styles['Normal']
+    assert normal.font.name == 'Times New Roman'
+    assert normal.font.size == Pt(12)
+    assert normal.paragraph_format.line_spacing == 1.5
+    assert normal.paragraph_format.first_line_indent.twips == Cm(1.25).twips
+    other = doc.paragraphs[1].paragraph_format
+    assert doc.paragraphs[1].alignment == WD_ALIGN_PARAGRAPH.JUSTIFY
+    assert other.first_line_indent.twips == Cm(1.25).twips
+    assert (other.space_before, other.space_after) == (Pt(0), Pt(0))
+
+
+def test_heading_caps_keep_runs():
+    doc = Document()
+    h1 = doc.add_paragraph(style='Heading 1')
+    h1.add_run('Intro')
+    h1.add_run('dução').bold = True
+    doc.add_paragraph('Objetivos', style='Heading 2')
+    abnt.apply_abnt_formatting(doc, h2_caps=False, auto_captions_tab=False)
+
+    assert h1.text == 'INTRODUÇÃO'
+    assert [(r.text, r.bold) for r in h1.runs] == [('INTRO', None), ('DUÇÃO', True)]
+    assert h1.alignment == WD_ALIGN_PARAGRAPH.LEFT
+    assert h1.paragraph_format.first_line_indent == 0
+    assert doc.paragraphs[1].text == 'Objetivos'
+
+
+def test_long_quote_block():
+    doc = _formatted(['Antes.', '[[CITACAO_LONGA]]Trecho citado com mais de três linhas.[[/CITACAO_LONGA]]',
+                      'Depois.'])
+
+    quote = doc.paragraphs[1]
+    assert quote.text == 'Trecho citado com mais de três linhas.'
+    pf = quote.paragraph_format
+    assert pf.left_indent.twips == Cm(4).twips
+    assert (pf.first_line_indent, pf.right_indent, pf.line_spacing) == (0, 0, 1.0)
+    assert quote.alignment == WD_ALIGN_PARAGRAPH.JUSTIFY
+    assert all(r.font.size == Pt(10) for r in quote.runs)
+    # O corpo e o estilo compartilhado continuam em 12 pt
+    assert doc.styles['Normal'].font.size == Pt(12)
+    after = doc.paragraphs[2]
+    assert after.paragraph_format.left_indent is None
+    assert all(r.font.size is None for r in after.runs)
+
+
+def test_marker_split_across_runs_is_stripped():
+    doc = Document()
+    p = doc.add_paragraph()
+    p.add_run('[[CITA')
+    p.add_run('CAO_LONGA]]Trecho ').bold = True
+    p.add_run('citado.[[/CITACAO_LONGA]]')
+    abnt.apply_abnt_formatting(doc, auto_captions_tab=False)
+
+    assert p.text == 'Trecho citado.'
+    assert [(r.text, r.bold) for r in p.runs] == [('', None), ('Trecho ', True), ('citado.', None)]
+    assert p.paragraph_format.left_indent.twips == Cm(4).twips
+
+
+def test_reference_block_indent():
+    doc = _formatted(['Texto.', '[[REFERENCIAS]]', 'SILVA, J. Livro. São Paulo: Editora, 2020.',
+                      'SOUZA, M. Artigo. Revista, v. 1, p. 1-10, 2021.', '[[/REFERENCIAS]]', 'Fim.'])
+
+    entries = doc.paragraphs[2:4]
+    for entry in entries:
+        pf = entry.paragraph_format
+        assert pf.left_indent.twips == Cm(1.25).twips
+        assert pf.first_line_indent == 0
+        assert (pf.line_spacing, pf.space_after) == (1.0, Pt(6))
+        assert entry.alignment == WD_ALIGN_PARAGRAPH.JUSTIFY
+    assert doc.paragraphs[-1].paragraph_format.left_indent is None
+
+    plain = _formatted(['[[REFERENCIAS]]SILVA, J. Livro. 2020.'], format_refs_block=False)
+    assert plain.paragraphs[0].text == '[[REFERENCIAS]]SILVA, J. Livro. 2020.'
+
+
+def test_figure_and_table_captions():
+    doc = Document()
+    fig = doc.add_paragraph()
+    # Só a presença de <w:drawing> identifica a figura
+    fig.add_run()._r.append(OxmlElement('w:drawing'))
+    doc.add_table(rows=1, cols=1)
+    abnt.apply_abnt_formatting(doc)
+
+    assert fig.alignment == WD_ALIGN_PARAGRAPH.CENTER
+    assert fig.paragraph_format.first_line_indent == 0
+    blocks = list(doc.element.body.iterchildren(qn('w:p'), qn('w:tbl')))
+    texts = [abnt._text_of(b) if b.tag == qn('w:p') else 'TABELA' for b in blocks]
+    assert texts == ['', 'Figura 1 – Descrição da figura', 'Tabela 1 – Título da tabela', 'TABELA',
+                     'Fonte: elaboração própria.']
+    captions = {p.text: p for p in doc.paragraphs}
+    for text, align in (('Figura 1 – Descrição da figura', WD_ALIGN_PARAGRAPH.CENTER),
+                        ('Tabela 1 – Título da tabela', WD_ALIGN_PARAGRAPH.CENTER),
+                        ('Fonte: elaboração própria.', WD_ALIGN_PARAGRAPH.LEFT)):
+        assert captions[text].alignment == align
+        assert captions[text].paragraph_format.first_line_indent == 0
+
+
+def test_footer_page_field():
+    doc = _formatted(['Texto.'])
+
+    para = doc.sections[0].footer.paragraphs[0]
+    assert para.alignment == WD_ALIGN_PARAGRAPH.RIGHT
+    r = para.runs[-1]._r
+    fld = [(c.tag, c.get(qn('w:fldCharType')) or c.text) for c in r if c.tag != qn('w:rPr')]
+    assert fld == [(qn('w:fldChar'), 'begin'), (qn('w:instrText'), ' PAGE '),
+                   (qn('w:fldChar'), 'separate'), (qn('w:fldChar'), 'end')]
+
+
+def test_runs_of_blank_lines_collapse():
+    doc = _formatted(['Um.', '', '', '  ', 'Dois.', '', 'Três.'])
+
+    assert [p.text for p in doc.paragraphs] == ['Um.', '', 'Dois.', '', 'Três.']